@@ -5,6 +5,8 @@ screenshot, OCR, and mouse/keyboard control.
 
 from . import util
 import math
+from collections import namedtuple
+from copy import copy
 
 # pylint: disable=import-outside-toplevel
 
@@ -19,6 +21,20 @@ def _default_backend():
     return tesseract.BackendTesseract()
 
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+
+
+def _copy_texts(texts):
+    # Copy the locators so that the caller can modify them without changing
+    # the cached results.
+    copied = list()
+    for t in texts:
+        t = copy(t)
+        t.location = copy(t.location)
+        copied.append(t)
+    return copied
+
+
 def _filter_locator(locator):
     try:
         locator = locator.center()
@@ -33,15 +49,31 @@ class Untriseptium:
         self.frontend = frontend if frontend else _default_frontend()
         self.ocrengine = ocrengine if ocrengine else _default_backend()
 
+        # Results of find_texts for the current ocrdata.
+        self._find_texts_cache = dict()
+        self._find_texts_cache_hits = 0
+        self._find_texts_cache_misses = 0
+
         self._clear_screenshot()
 
     def _clear_screenshot(self):
         self.screenshot = None
         self.ocrdata = None
+        self._find_texts_cache.clear()
+
+    def find_texts_cache_info(self):
+        '''
+        Returns hits, misses, and current size of the find_texts cache.
+        The cache is cleared when the screenshot or OCR data is updated.
+        '''
+        return CacheInfo(self._find_texts_cache_hits,
+                         self._find_texts_cache_misses,
+                         len(self._find_texts_cache))
 
     def capture(self):
         self.screenshot = self.frontend.screenshot()
         self.ocrdata = None
+        self._find_texts_cache.clear()
 
     def ocr(self, image_filter=None, crop=None):
         if not self.screenshot:
@@ -50,11 +82,43 @@ class Untriseptium:
         if image_filter:
             s = image_filter(s)
         self.ocrdata = self.ocrengine.ocr(s, crop)
+        self._find_texts_cache.clear()
 
     def find_texts(self, text, location_hint=None, color_hint=None, create_image=False, confidence_threshold=0.8, **kwargs):
+        '''
+        Returns the text locators matching the text, the best match first.
+        The results are cached until the screenshot or OCR data is updated if
+        the OCR engine provides find_texts_cache_key(). Each call returns new
+        locators so that modifying them does not change later results.
+        Calls that are not cached are counted as misses.
+        '''
         if not self.ocrdata:
             self.ocr()
 
+        key = None
+        cache_key = getattr(self.ocrengine, 'find_texts_cache_key', None)
+        if cache_key:
+            try:
+                key = util.make_hashable((text, location_hint, color_hint, create_image,
+                                          confidence_threshold, kwargs))
+                key = (key, cache_key())
+                texts = self._find_texts_cache.get(key)
+            except TypeError:
+                # Hints that cannot be hashed are not cached.
+                key = None
+                texts = None
+            if texts is not None:
+                self._find_texts_cache_hits += 1
+                return _copy_texts(texts)
+
+        self._find_texts_cache_misses += 1
+        texts = self._find_texts(text, location_hint, color_hint, create_image, confidence_threshold, **kwargs)
+        if key is not None:
+            self._find_texts_cache[key] = texts
+            return _copy_texts(texts)
+        return texts
+
+    def _find_texts(self, text, location_hint, color_hint, create_image, confidence_threshold, **kwargs):
         texts = self.ocrengine.find_texts(self.ocrdata, text, **kwargs)
 
         if confidence_threshold:
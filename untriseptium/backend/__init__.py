@@ -1 +1 @@
-__all__ = ['tesseract']
+__all__ = ['tesseract', 'daemon']
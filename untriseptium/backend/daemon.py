@@ -0,0 +1,407 @@
+'''
+Shared OCR service so that several automation processes on one host can use
+warm Tesseract engines held by a single daemon.
+
+Run the daemon:
+    python -m untriseptium.backend.daemon
+
+And use it from each client:
+    u = untriseptium.Untriseptium(ocrengine=BackendDaemon())
+
+The socket and the key to authenticate clients are created in
+$XDG_RUNTIME_DIR by default.
+The engines are kept loaded only if tesserocr is installed. Otherwise the
+daemon starts Tesseract for each request through pytesseract.
+'''
+
+import errno
+import logging
+import os
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from multiprocessing.connection import answer_challenge, deliver_challenge
+from untriseptium.backend.tesseract import BackendTesseract
+from untriseptium.util import Location, make_hashable
+
+_logger = logging.getLogger(__name__)
+
+# Attributes of BackendTesseract that affect the OCR result and that are
+# therefore sent along with each request.
+_ENGINE_SETTINGS = ('lang', 'ocr_split_height', 'ocr_split_depth',
+                    'lang_routes', 'lang_route_threshold')
+
+_TSV_HEADER = 'level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\t' \
+              'left\ttop\twidth\theight\tconf\ttext'
+
+
+def _runtime_dir():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        raise ValueError('XDG_RUNTIME_DIR is not set. '
+                         'Specify the address and the authkey.')
+    return runtime_dir
+
+
+def _default_address():
+    return os.path.join(_runtime_dir(), 'untriseptium-ocr.sock')
+
+
+def _default_authkey_file():
+    return os.path.join(_runtime_dir(), 'untriseptium-ocr.key')
+
+
+def read_authkey(path, create=False):
+    '''
+    Reads the key to authenticate the clients.
+    :args:
+    - path: Path of the key file.
+    - create: Create the file with a random key if it does not exist.
+    '''
+    if create and not os.path.exists(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32).hex().encode())
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+
+def _remove_stale_socket(address):
+    # Remove only a socket left by a daemon that is not running anymore.
+    try:
+        st = os.lstat(address)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(f'{address} exists and is not a socket')
+    try:
+        Client(address, family='AF_UNIX').close()
+    except OSError:
+        os.unlink(address)
+        return
+    raise FileExistsError(f'Another process is listening on {address}')
+
+
+# Errors of accept() that go away when other clients disconnect.
+_ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+# Errors of accept() caused by a client that is already gone.
+_ACCEPT_TRANSIENT_ERRORS = (errno.ECONNABORTED, errno.EINTR, errno.EPROTO)
+
+
+def _encode_image(image):
+    # The palette is not sent with the raw pixels.
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    elif image.mode == 'PA':
+        image = image.convert('RGBA')
+    return (image.mode, image.size, image.tobytes())
+
+
+def _decode_image(data):
+    import PIL.Image
+    mode, size, buf = data
+    return PIL.Image.frombytes(mode, size, buf)
+
+
+def _shift_ocrdata(data, offset):
+    for t in data:
+        t.left += offset[0]
+        t.top += offset[1]
+        t.location = Location(t.left, t.top, t.left + t.width, t.top + t.height)
+    return data
+
+
+class _WarmApis(threading.local):
+    '''
+    Tesseract engines kept loaded for each worker thread and language.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.apis = dict()
+
+    def get(self, lang):
+        api = self.apis.get(lang)
+        if not api:
+            import tesserocr
+            api = tesserocr.PyTessBaseAPI(lang=lang)
+            self.apis[lang] = api
+        return api
+
+    def end(self):
+        for api in self.apis.values():
+            api.End()
+        self.apis.clear()
+
+
+class _WarmTesseract(BackendTesseract):
+    def __init__(self, apis):
+        super().__init__()
+        self._apis = apis
+
+    def _image_to_data(self, image, lang, single_line=False):
+        import tesserocr
+        api = self._apis.get(lang if lang else 'eng')
+        api.SetPageSegMode(tesserocr.PSM.SINGLE_LINE if single_line else tesserocr.PSM.AUTO)
+        api.SetImage(image)
+        return _TSV_HEADER + '\n' + api.GetTSVText(0)
+
+
+class _Job:
+    def __init__(self, engine, image):
+        self.engine = engine
+        self.image = image
+        self.future = Future()
+
+
+class OcrDaemon:
+    '''
+    Accepts OCR requests from BackendDaemon clients over a Unix socket.
+    The requests from all clients go into one queue and each worker thread
+    takes the oldest job. Each worker keeps its own engines loaded.
+    :args:
+    - address: Path of the Unix socket.
+    - max_workers: Number of OCR requests processed at the same time.
+      Defaults to the number of CPUs.
+    - authkey: Bytes to authenticate clients. Defaults to the content of a
+      key file created next to the default socket.
+    '''
+    def __init__(self, address=None, max_workers=None, authkey=None):
+        self.address = address if address else _default_address()
+        self.max_workers = max_workers if max_workers else os.cpu_count() or 1
+        self.authkey = authkey if authkey else read_authkey(_default_authkey_file(), create=True)
+        self._engines = dict()
+        self._apis = _WarmApis()
+        self._jobs = deque()
+        self._jobs_cond = threading.Condition()
+        self._stopping = threading.Event()
+        try:
+            import tesserocr  # pylint: disable=unused-import
+            self._warm = True
+        except ImportError:
+            self._warm = False
+
+    def _engine(self, settings):
+        # Engines are kept for each set of settings so that clients with
+        # different presets can share the daemon.
+        key = make_hashable(settings)
+        with self._jobs_cond:
+            engine = self._engines.get(key)
+            if not engine:
+                engine = _WarmTesseract(self._apis) if self._warm else BackendTesseract()
+                for name, value in settings.items():
+                    setattr(engine, name, value)
+                # The lines are re-read on the worker itself so that the
+                # number of workers limits the load of the host.
+                engine.ocr_workers = 1
+                self._engines[key] = engine
+        return engine
+
+    def _next_job(self):
+        with self._jobs_cond:
+            while not self._jobs and not self._stopping.is_set():
+                self._jobs_cond.wait()
+            if not self._jobs:
+                return None
+            return self._jobs.popleft()
+
+    def _worker(self):
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    break
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    data = job.engine.ocr(_decode_image(job.image))
+                    job.future.set_result(data)
+                except Exception as e:  # pylint: disable=broad-except
+                    job.future.set_exception(e)
+        finally:
+            self._apis.end()
+
+    def _handle(self, request):
+        command, settings, jobs = request
+        if command != 'ocr':
+            raise ValueError(f'Unknown command: {command}')
+        engine = self._engine(settings)
+        jobs = [_Job(engine, image) for image in jobs]
+        with self._jobs_cond:
+            self._jobs.extend(jobs)
+            self._jobs_cond.notify_all()
+        return [job.future.result() for job in jobs]
+
+    def _serve_connection(self, conn):
+        with conn:
+            try:
+                deliver_challenge(conn, self.authkey)
+                answer_challenge(conn, self.authkey)
+            except (AuthenticationError, OSError, EOFError):
+                return
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    response = ('ok', self._handle(request))
+                except Exception as e:  # pylint: disable=broad-except
+                    response = ('error', repr(e))
+                try:
+                    conn.send(response)
+                except OSError:
+                    break
+
+    def serve_forever(self):
+        '''
+        Accepts clients until shutdown() is called.
+        '''
+        _remove_stale_socket(self.address)
+        workers = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(self.max_workers)]
+        for w in workers:
+            w.start()
+        try:
+            # Only the owner can connect to the socket.
+            umask = os.umask(0o177)
+            try:
+                # Clients are authenticated in _serve_connection so that a
+                # slow client does not block the others.
+                listener = Listener(self.address, family='AF_UNIX')
+            finally:
+                os.umask(umask)
+            with listener:
+                backoff = 0.01
+                while not self._stopping.is_set():
+                    try:
+                        conn = listener.accept()
+                    except OSError as e:
+                        if self._stopping.is_set():
+                            break
+                        if e.errno in _ACCEPT_RESOURCE_ERRORS:
+                            _logger.warning('Failed to accept a client: %s', e)
+                            time.sleep(backoff)
+                            backoff = min(backoff * 2, 1.0)
+                            continue
+                        if e.errno in _ACCEPT_TRANSIENT_ERRORS:
+                            continue
+                        raise
+                    backoff = 0.01
+                    if self._stopping.is_set():
+                        conn.close()
+                        break
+                    threading.Thread(target=self._serve_connection,
+                                     args=(conn,), daemon=True).start()
+        finally:
+            self._stopping.set()
+            with self._jobs_cond:
+                self._jobs_cond.notify_all()
+            for w in workers:
+                w.join()
+
+    def shutdown(self):
+        '''
+        Stops serve_forever() running in another thread.
+        '''
+        self._stopping.set()
+        # Wake up accept() in serve_forever().
+        try:
+            Client(self.address, family='AF_UNIX').close()
+        except OSError:
+            pass
+
+
+class BackendDaemon(BackendTesseract):
+    '''
+    OCR backend that sends the images to OcrDaemon instead of running
+    Tesseract in this process.
+    Presets and text search work in the same way as BackendTesseract.
+    :args:
+    - address: Path of the Unix socket the daemon listens on.
+    - authkey: Bytes to authenticate to the daemon.
+    - authkey_file: File containing the key, given to the daemon by
+      --authkey-file. Used if authkey is not given. Defaults to the key file
+      created by the daemon.
+    '''
+    def __init__(self, address=None, authkey=None, authkey_file=None):
+        super().__init__()
+        self.address = address if address else _default_address()
+        self.authkey = authkey
+        self.authkey_file = authkey_file
+        self._conn = None
+
+    def _connection(self):
+        if not self._conn:
+            if not self.authkey:
+                path = self.authkey_file if self.authkey_file else _default_authkey_file()
+                self.authkey = read_authkey(path)
+            self._conn = Client(self.address, family='AF_UNIX',
+                                authkey=self.authkey)
+        return self._conn
+
+    def close(self):
+        '''
+        Closes the connection to the daemon.
+        '''
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def ocr_batch(self, requests):
+        '''
+        Runs OCR on several images at once and returns a list of ocrdata.
+        The daemon processes the images in parallel.
+        :args:
+        - requests: List of tuples of an image and a crop region or None.
+        '''
+        settings = {name: getattr(self, name) for name in _ENGINE_SETTINGS}
+        jobs = list()
+        offsets = list()
+        for image, crop in requests:
+            # Send only the cropped region and move the result back.
+            if crop:
+                image = image.crop(crop)
+                offsets.append((crop[0], crop[1]))
+            else:
+                offsets.append((0, 0))
+            jobs.append(_encode_image(image))
+
+        conn = self._connection()
+        try:
+            conn.send(('ocr', settings, jobs))
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            self.close()
+            raise
+        if status != 'ok':
+            raise RuntimeError(f'OCR daemon failed: {result}')
+        return [_shift_ocrdata(data, offset) for data, offset in zip(result, offsets)]
+
+    def ocr(self, image, crop=None):
+        return self.ocr_batch([(image, crop)])[0]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Shared OCR daemon for untriseptium')
+    parser.add_argument('--address', default=None,
+                        help='Path of the Unix socket')
+    parser.add_argument('--authkey-file', default=None,
+                        help='File containing the key to authenticate clients')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of OCR requests processed at the same time')
+    args = parser.parse_args()
+    authkey = read_authkey(args.authkey_file, create=True) if args.authkey_file else None
+    daemon = OcrDaemon(address=args.address, max_workers=args.workers,
+                       authkey=authkey)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 import editdistance
 from copy import deepcopy
-from untriseptium.util import TextLocator, Location
+from untriseptium.util import TextLocator, Location, make_hashable
 
 
 def _weighted_sum(v1, w1, v2, w2):
@@ -46,6 +48,7 @@ class _Text():
         self.confidence = 0
         self.text = ''
         self.location = None
+        self.lang = None
 
     def __str__(self):
         right = self.left+self.width
@@ -124,6 +127,78 @@ def _ocrdata_has_valid_data(ocrdata):
     return False
 
 
+def _is_latin(c):
+    return ord(c) < 0x250
+
+
+def _is_cjk(c):
+    o = ord(c)
+    return 0x3000 <= o < 0x3100 or 0x3400 <= o < 0xa000 or 0xff00 <= o < 0xfff0
+
+
+def _is_cjk_or_latin(c):
+    return _is_cjk(c) or _is_latin(c)
+
+
+# Characters each language model can output.
+# The CJK models also output Latin letters.
+_LANG_SCRIPTS = {
+        'eng': _is_latin,
+        'jpn': _is_cjk_or_latin,
+        'chi_sim': _is_cjk_or_latin,
+        'chi_tra': _is_cjk_or_latin,
+        }
+
+
+def _in_script(text, lang):
+    check = _LANG_SCRIPTS.get(lang)
+    if not check:
+        return True
+    return all(not c.isalpha() or check(c) for c in text)
+
+
+def _split_lines(ocrdata):
+    '''
+    Splits ocrdata into lines. Each line starts with the entries without text
+    (page, block, paragraph, and line) followed by the words.
+    '''
+    lines = list()
+    line = list()
+    for t in ocrdata:
+        if t.confidence < 0 and any(w.confidence >= 0 for w in line):
+            lines.append(line)
+            line = list()
+        line.append(t)
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _script_score(words, lang):
+    '''
+    Returns how well the words are read by the language model.
+    The OCR confidence is lowered if the output contains characters that the
+    language model cannot output.
+    '''
+    check = _LANG_SCRIPTS.get(lang)
+    conf_tot = 0.0
+    textlen_total = 0
+    n_script = 0
+    for t in words:
+        if t.confidence < 0:
+            continue
+        conf_tot += t.confidence * len(t.text)
+        textlen_total += len(t.text)
+        if check:
+            n_script += sum(1 for c in t.text if not c.isalpha() or check(c))
+    if not textlen_total:
+        return 0.0
+    score = conf_tot / textlen_total
+    if check:
+        score *= n_script / textlen_total
+    return score
+
+
 class BackendTesseract:
     def __init__(self):
         # FIXME: Workaround to avoid system to be shutdown
@@ -142,20 +217,48 @@ class BackendTesseract:
         self.confidence_threshold = 0.2
         self.ocr_split_height = 128
         self.ocr_split_depth = 2
+        # Languages to route each text line to. The first language reads the
+        # whole screen and the others are tried on the lines it cannot read.
+        self.lang_routes = None
+        self.lang_route_threshold = 0.6
+        # Matching method for the words read by each language.
+        self.lang_matchers = dict()
+        # Number of Tesseract processes to re-read the lines in parallel.
+        self.ocr_workers = os.cpu_count() or 1
 
     def preset(self, preset_name):
         if preset_name == 'ja':
             self.lang = 'jpn'
+            self.lang_routes = None
             self.find_texts = self._find_texts_para_partial
+        elif preset_name == 'en+ja':
+            # The screen is read in English first. Only the words read with
+            # low confidence and the lines without any word are read again in
+            # Japanese. This is a fallback pass and a screen mostly in
+            # Japanese is still read in English first.
+            self.lang_routes = ['eng', 'jpn']
+            # Japanese has no space between words and Tesseract splits the
+            # text at different positions from the query. Match each part of
+            # the query to the words.
+            self.lang_matchers = {'jpn': self._find_texts_char}
+            # Remove the matcher set by another preset.
+            vars(self).pop('find_texts', None)
+
+    def _image_to_data(self, image, lang, single_line=False):
+        # Returns the result of Tesseract in TSV format including the header.
+        from pytesseract import pytesseract
+        config = '--psm 7' if single_line else ''
+        return pytesseract.image_to_data(image, lang=lang, config=config)
 
-    def _ocr_subregion(self, image, subregion):
+    def _ocr_subregion(self, image, subregion, lang=None, single_line=False):
         if subregion:
             image = image.crop(subregion)
             offset = subregion
         else:
             offset = (0, 0)
-        from pytesseract import pytesseract
-        tsv = pytesseract.image_to_data(image, lang=self.lang)
+        if not lang:
+            lang = self.lang
+        tsv = self._image_to_data(image, lang, single_line)
 
         data = list()
         header = None
@@ -171,12 +274,13 @@ class BackendTesseract:
                 d._set(header, line, offset)
             except BaseException as e:
                 raise (Exception('Failed to parse line: "%s"' % line, e))
+            d.lang = lang
             data.append(d)
 
         return data
 
-    def _ocr_pyramid_subregion(self, image, subregion, depth=0):
-        data = self._ocr_subregion(image, subregion)
+    def _ocr_pyramid_subregion(self, image, subregion, depth=0, lang=None):
+        data = self._ocr_subregion(image, subregion, lang)
 
         # Tesseract sometimes returns nothing when the image is big.
         # This is a workaround to have smaller image.
@@ -194,15 +298,96 @@ class BackendTesseract:
             h1 = self.ocr_split_height
         for y in range(subregion[1], subregion[3] - h1, h_step):
             sr1 = (subregion[0], y, subregion[2], y + h1)
-            data1 = self._ocr_pyramid_subregion(image, sr1, depth+1)
+            data1 = self._ocr_pyramid_subregion(image, sr1, depth+1, lang)
             for t in data1:
                 data.append(t)
 
         return data
 
+    def _route_runs(self, line, primary):
+        '''
+        Returns the ranges of the words in the line that the first language
+        may have misread, and the locations to read again.
+        '''
+        runs = list()
+        words = [i for i, t in enumerate(line) if t.confidence >= 0 and t.text]
+        if not words:
+            # The first language could not read anything from the line.
+            for t in line:
+                if t.level == 4:
+                    runs.append((len(line), len(line), [t.location]))
+            return runs
+
+        run = None
+        for i in words:
+            t = line[i]
+            if t.confidence < self.lang_route_threshold or not _in_script(t.text, primary):
+                if not run:
+                    run = [i, i + 1, list()]
+                run[1] = i + 1
+                run[2].append(t.location)
+            elif run:
+                runs.append(tuple(run))
+                run = None
+        if run:
+            runs.append(tuple(run))
+        return runs
+
+    def _route_region(self, locations, crop):
+        x0 = min(loc.x0 for loc in locations)
+        y0 = min(loc.y0 for loc in locations)
+        x1 = max(loc.x1 for loc in locations)
+        y1 = max(loc.y1 for loc in locations)
+        # Tesseract needs some margin around the text.
+        margin = (y1 - y0) // 2
+        return (max(x0 - margin, crop[0]), max(y0 - margin, crop[1]),
+                min(x1 + margin, crop[2]), min(y1 + margin, crop[3]))
+
+    def _ocr_routed(self, image, crop):
+        primary = self.lang_routes[0]
+        others = self.lang_routes[1:]
+        lines = _split_lines(self._ocr_pyramid_subregion(image, crop, lang=primary))
+
+        # Words the first language cannot read well are likely written in
+        # another script. Read only these words with the other languages.
+        jobs = list()
+        for i, line in enumerate(lines):
+            for start, end, locations in self._route_runs(line, primary):
+                region = self._route_region(locations, crop)
+                jobs += [(i, start, end, lang, region) for lang in others]
+
+        def read(job):
+            return self._ocr_subregion(image, job[4], job[3], single_line=True)
+
+        if self.ocr_workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.ocr_workers) as executor:
+                results = list(executor.map(read, jobs))
+        else:
+            results = [read(job) for job in jobs]
+
+        # Take the reading with the best score for each run if it is good
+        # enough.
+        best = dict()
+        for (i, start, end, lang, _), data in zip(jobs, results):
+            words = [t for t in data if t.confidence >= 0 and t.text]
+            score = _script_score(words, lang)
+            if (i, start) not in best:
+                best[(i, start)] = (end, _script_score(lines[i][start:end], primary), None)
+            if score >= self.lang_route_threshold and score > best[(i, start)][1]:
+                best[(i, start)] = (end, score, words)
+
+        # Replace from the end so that the indices of the other runs are kept.
+        for (i, start), (end, _, words) in sorted(best.items(), reverse=True):
+            if words is not None:
+                lines[i][start:end] = words
+
+        return [t for line in lines for t in line]
+
     def ocr(self, image, crop=None):
         if not crop:
             crop = (0, 0, image.width, image.height)
+        if self.lang_routes:
+            return self._ocr_routed(image, crop)
         return self._ocr_pyramid_subregion(image, crop)
 
     def _conf_ocr_text(self, ocr_txt, ideal_txt):
@@ -222,9 +407,31 @@ class BackendTesseract:
             conf_dist = 0.0
         return conf_dist
 
+    def find_texts_cache_key(self):
+        '''
+        Returns a key that changes when the result of find_texts changes for
+        the same data.
+        '''
+        matcher = getattr(self.find_texts, '__func__', self.find_texts)
+        return make_hashable((matcher, self.lang_routes, self.lang_matchers,
+                              self.confidence_threshold, self.ocr_unconfidence_ratio))
+
     def find_texts(self, data, text):
+        if self.lang_routes:
+            return self._find_texts_per_lang(data, text)
         return self._find_texts_para_partial(data, text)
 
+    def _find_texts_per_lang(self, data, text):
+        # Each language has its own matcher. Words of the other languages are
+        # removed but the entries without text are kept as separators.
+        langs = {t.lang for t in data if t.confidence >= 0}
+        cand = list()
+        for lang in langs:
+            subdata = [t for t in data if t.confidence < 0 or t.lang == lang]
+            matcher = self.lang_matchers.get(lang, self._find_texts_para_partial)
+            cand += matcher(subdata, text)
+        return sorted(cand, key=lambda d: (-d.confidence, getattr(d, 'sum_inv_spaces', 0.0)))
+
     def _find_texts_word(self, data, text):
         text = text.split(' ')
 
@@ -280,6 +487,8 @@ class BackendTesseract:
             for i_start in range(len(text)):
                 for i_end in range(i_start + 1, len(text) + 1):
                     t = text[i_start:i_end].strip()
+                    if not t:
+                        continue
 
                     conf = self._conf_ocr_text(ocr_txt, t)
                     if conf < self.confidence_threshold:
@@ -119,6 +119,19 @@ def color_difference(c1, c2):
     raise ValueError('Two colors need to be the same dimention.')
 
 
+def make_hashable(value):
+    '''
+    Converts lists and dicts into tuples so that the value can be used as a
+    key of a dict.
+    The type of each element is kept so that 1 and 1.0 are different keys.
+    '''
+    if isinstance(value, (list, tuple)):
+        return (tuple, tuple(make_hashable(v) for v in value))
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((k, make_hashable(v)) for k, v in value.items())))
+    return (type(value), value)
+
+
 def make_color(c):
     if isinstance(c, str):
         return PIL.ImageColor.getrgb(c)